@@ -1,23 +1,44 @@
+import gzip
+
+import pytest
 from pytest_httpserver import HTTPServer
 from werkzeug import Response
 
-from verdin.datasource import Datasource, FileDatasource
+from verdin.datasource import Datasource, FileDatasource, to_ndjson
 
 
 class TestDatasource:
-    def test_to_csv(self):
-        records = [["a", "1", "{}"], ["b", "2", '{"foo":"bar","baz":"ed"}']]
-
-        csv = Datasource.to_csv(records)
-
-        assert csv == """a,1,{}\nb,2,"{""foo"":""bar"",""baz"":""ed""}"\n"""
-
-    def test_to_csv_with_delimiter(self):
-        records = [["a", "1", "{}"], ["b", "2", '{"foo":"bar","baz":"ed"}']]
-
-        csv = Datasource.to_csv(records, delimiter=";")
-
-        assert csv == """a;1;{}\nb;2;"{""foo"":""bar"",""baz"":""ed""}"\n"""
+    records = [["a", "1", "{}"], ["b", "2", '{"foo":"bar","baz":"ed"}']]
+
+    @pytest.mark.parametrize(
+        "delimiter,expected",
+        [
+            (None, """a,1,{}\nb,2,"{""foo"":""bar"",""baz"":""ed""}"\n"""),
+            (";", """a;1;{}\nb;2;"{""foo"":""bar"",""baz"":""ed""}"\n"""),
+        ],
+    )
+    def test_to_csv(self, delimiter, expected):
+        if delimiter is None:
+            csv = Datasource.to_csv(self.records)
+        else:
+            csv = Datasource.to_csv(self.records, delimiter=delimiter)
+
+        assert csv == expected
+
+    def test_canonical_name(self):
+        assert Datasource("mydatasource", None).canonical_name == "mydatasource"
+        assert Datasource("mydatasource", None, version=2).canonical_name == "mydatasource__v2"
+        assert str(Datasource("mydatasource", None, version=0)) == "Datasource(mydatasource__v0)"
+
+        ds = Datasource("mydatasource", None)
+        ds.version = 3
+        assert ds.canonical_name == "mydatasource__v3"
+
+    def test_iter_csv(self):
+        chunks = list(Datasource.iter_csv(self.records, chunk_size=4))
+
+        assert len(chunks) == 2
+        assert b"".join(chunks).decode("utf-8") == Datasource.to_csv(self.records)
 
     def test_append(self, httpserver: HTTPServer):
         ds = Datasource("mydatasource", "123456", api=httpserver.url_for("/"))
@@ -27,6 +48,7 @@ class TestDatasource:
         def handler(request):
             actual_data = request.data.decode()
             assert expected_data in actual_data
+            assert request.headers["Authorization"] == "Bearer 123456"
             return Response("", 200)
 
         httpserver.expect_request(
@@ -38,6 +60,61 @@ class TestDatasource:
         httpserver.check()
         assert response.ok
 
+    def test_append_uses_current_token(self, httpserver: HTTPServer):
+        ds = Datasource("mydatasource", "123456", api=httpserver.url_for("/"))
+        ds.token = "67890"
+
+        def handler(request):
+            assert request.headers["Authorization"] == "Bearer 67890"
+            return Response("", 200)
+
+        httpserver.expect_request("/v0/datasources").respond_with_handler(handler)
+
+        assert ds.append([["a", "1"]]).ok
+        assert ds.append_ndjson([{"a": "1"}]).ok
+        httpserver.check()
+
+    def test_append_ndjson(self, httpserver: HTTPServer):
+        ds = Datasource("mydatasource", "123456", api=httpserver.url_for("/"))
+
+        def handler(request):
+            lines = request.data.decode().splitlines()
+            assert lines == ['{"a":"1","b":{}}', '{"a":"2","b":{"foo":"bar"}}']
+            return Response("", 200)
+
+        httpserver.expect_request(
+            "/v0/datasources",
+            query_string={"name": "mydatasource", "mode": "append", "format": "ndjson"},
+        ).respond_with_handler(handler)
+
+        response = ds.append_ndjson([{"a": "1", "b": {}}, {"a": "2", "b": {"foo": "bar"}}])
+        httpserver.check()
+        assert response.ok
+
+    def test_append_compressed(self, httpserver: HTTPServer):
+        ds = Datasource("mydatasource", "123456", api=httpserver.url_for("/"))
+
+        def handler(request):
+            assert request.headers["Content-Encoding"] == "gzip"
+            assert gzip.decompress(request.get_data()) == b'a,1,{}\nb,2,"{""foo"":""bar""}"\n'
+            return Response("", 200)
+
+        httpserver.expect_request("/v0/datasources").respond_with_handler(handler)
+
+        response = ds.append_csv([["a", "1", "{}"], ["b", "2", '{"foo":"bar"}']], compress=True)
+        httpserver.check()
+        assert response.ok
+
+    def test_to_ndjson_with_serialized_records(self):
+        records = [{"a": "1"}, '{"a":"2"}', b'{"a":"3"}']
+
+        assert to_ndjson(records) == b'{"a":"1"}\n{"a":"2"}\n{"a":"3"}\n'
+
+    def test_to_ndjson_with_newline_terminated_records(self):
+        records = ['{"a":"1"}\n', b'{"a":"2"}\r\n', '{"a":"3"}']
+
+        assert to_ndjson(records) == b'{"a":"1"}\n{"a":"2"}\n{"a":"3"}\n'
+
 
 class TestFileDatasource:
     def test_append(self, tmp_path):
@@ -1,6 +1,14 @@
-from typing import Dict, Optional
+import re
+import threading
+from typing import Dict, List, Optional
 
-from verdin.pipe import PagedPipeQuery, PipeMetadata
+import pytest
+import requests
+from pytest_httpserver import HTTPServer
+
+from verdin import config
+from verdin.client import Client
+from verdin.pipe import PagedPipeQuery, Pipe, PipeError, PipeJsonResponse, PipeMetadata
 
 
 class MockPipeJsonResponse:
@@ -10,22 +18,190 @@ class MockPipeJsonResponse:
         self.meta = meta
 
 
-class TestPagedPipeQuery:
-    def test(self):
-        queries = list()
+class MockPipe:
+    def __init__(self, rows: int):
+        self.rows = rows
+        self.queries: List[str] = []
+        self.mutex = threading.Lock()
+
+    def sql(self, query):
+        with self.mutex:
+            self.queries.append(query)
+
+        offset = int(re.search(r"OFFSET (\d+)", query).group(1))
+
+        if offset >= self.rows:
+            return MockPipeJsonResponse(empty=True, data=None, meta=[])
+
+        return MockPipeJsonResponse(empty=False, data={"offset": offset}, meta=[])
+
+
+class TestPipeJsonResponse:
+    def test_to_columns(self):
+        response = requests.Response()
+        response._content = b"""{
+            "meta": [{"name": "a", "type": "String"}, {"name": "b", "type": "Int32"}],
+            "data": [{"a": "x", "b": 1}, {"a": "y", "b": 2}]
+        }"""
+
+        assert PipeJsonResponse(response).to_columns() == {"a": ["x", "y"], "b": [1, 2]}
+
+    def test_meta(self):
+        response = requests.Response()
+        response._content = b"""{
+            "meta": [{"name": "a", "type": "String"}, {"name": "b", "type": "Int32"}],
+            "data": []
+        }"""
+
+        assert PipeJsonResponse(response).meta == [("a", "String"), ("b", "Int32")]
+
+    def test_to_columns_single_column_and_empty(self):
+        response = requests.Response()
+        response._content = b'{"meta": [{"name": "a", "type": "String"}], "data": [{"a": "x"}]}'
+        assert PipeJsonResponse(response).to_columns() == {"a": ["x"]}
+
+        response = requests.Response()
+        response._content = b'{"meta": [{"name": "a", "type": "String"}], "data": []}'
+        assert PipeJsonResponse(response).to_columns() == {"a": []}
+
+
+class TestPipe:
+    def test_pipe_url(self):
+        pipe = Pipe("mypipe", None, api="http://localhost:8001/")
+        assert pipe.canonical_name == "mypipe"
+        assert pipe.pipe_url == "http://localhost:8001/v0/pipes/mypipe.json"
+
+        pipe = Pipe("mypipe", None, version=3)
+        assert pipe.canonical_name == "mypipe__v3"
+        assert pipe.pipe_url == "https://api.tinybird.co/v0/pipes/mypipe__v3.json"
+
+        pipe = Client("12345", api="http://localhost:8001/").pipe("mypipe")
+        assert pipe.pipe_url == "http://localhost:8001/v0/pipes/mypipe.json"
+
+        pipe.version = 2
+        assert pipe.canonical_name == "mypipe__v2"
+        assert pipe.pipe_url == "http://localhost:8001/v0/pipes/mypipe__v2.json"
+
+    def test_pipe_url_with_overridden_api_url(self, monkeypatch):
+        monkeypatch.setattr(config, "API_URL", "http://localhost:8001/")
+
+        assert Pipe("mypipe", None).pipe_url == "http://localhost:8001/v0/pipes/mypipe.json"
+        pipe = Client("12345").pipe("mypipe")
+        assert pipe.pipe_url == "http://localhost:8001/v0/pipes/mypipe.json"
+
+    def test_query_error(self, httpserver: HTTPServer):
+        httpserver.expect_request("/v0/pipes/mypipe.json").respond_with_json(
+            {"error": "invalid pipe"}, status=400
+        )
 
-        class MockPipe:
-            def sql(self, query):
-                queries.append(query)
+        pipe = Pipe("mypipe", "12345", api=httpserver.url_for("/"))
 
-                if len(queries) == 2:
-                    return MockPipeJsonResponse(empty=True, data=None, meta=[])
+        with pytest.raises(PipeError) as e:
+            pipe.query()
+        e.match("invalid pipe")
+        assert e.value.json == {"error": "invalid pipe"}
 
-                return MockPipeJsonResponse(empty=False, data={}, meta=[])
+    def test_sql_sends_token(self, httpserver: HTTPServer):
+        httpserver.expect_request(
+            "/v0/pipes/mypipe.json",
+            query_string={"q": "select 1"},
+            headers={"Authorization": "Bearer 12345"},
+        ).respond_with_json({"meta": [], "data": []})
 
-        for page in PagedPipeQuery(pipe=MockPipe(), page_size=10, start_at=0):
+        pipe = Pipe("mypipe", "12345", api=httpserver.url_for("/"))
+
+        assert pipe.sql("select 1").empty
+
+        # changing the token is picked up by subsequent requests
+        httpserver.clear()
+        httpserver.expect_request(
+            "/v0/pipes/mypipe.json",
+            query_string={"q": "select 1"},
+            headers={"Authorization": "Bearer 67890"},
+        ).respond_with_json({"meta": [], "data": []})
+
+        pipe.token = "67890"
+        assert pipe.sql("select 1").empty
+
+    def test_query_error_without_json(self, httpserver: HTTPServer):
+        httpserver.expect_request("/v0/pipes/mypipe.json").respond_with_data(
+            "Internal Server Error", status=500
+        )
+
+        pipe = Pipe("mypipe", "12345", api=httpserver.url_for("/"))
+
+        with pytest.raises(PipeError) as e:
+            pipe.sql("select * from _")
+        e.match("Internal Server Error")
+        assert e.value.json == {}
+
+
+class TestPagedPipeQuery:
+    @pytest.mark.parametrize(
+        "page_size,start_at,rows,expected_queries",
+        [
+            (
+                10,
+                0,
+                10,
+                ["SELECT * FROM _ LIMIT 10 OFFSET 0", "SELECT * FROM _ LIMIT 10 OFFSET 10"],
+            ),
+            (5, 20, 25, ["SELECT * FROM _ LIMIT 5 OFFSET 20", "SELECT * FROM _ LIMIT 5 OFFSET 25"]),
+            (
+                50,
+                0,
+                100,
+                [
+                    "SELECT * FROM _ LIMIT 50 OFFSET 0",
+                    "SELECT * FROM _ LIMIT 50 OFFSET 50",
+                    "SELECT * FROM _ LIMIT 50 OFFSET 100",
+                ],
+            ),
+            (10, 0, 0, ["SELECT * FROM _ LIMIT 10 OFFSET 0"]),
+        ],
+    )
+    def test(self, page_size, start_at, rows, expected_queries):
+        pipe = MockPipe(rows=rows)
+
+        result = list(PagedPipeQuery(pipe=pipe, page_size=page_size, start_at=start_at))
+
+        assert len(result) == len(expected_queries) - 1
+        for page in result:
             assert page.empty is False
 
-        assert len(queries) == 2
-        assert queries[0] == "SELECT * FROM _ LIMIT 10 OFFSET 0"
-        assert queries[1] == "SELECT * FROM _ LIMIT 10 OFFSET 10"
+        assert pipe.queries == expected_queries
+
+    def test_prefetch(self):
+        pipe = MockPipe(rows=50)
+
+        query = PagedPipeQuery(pipe=pipe, page_size=10, start_at=0, prefetch=2)
+        result = list(query)
+
+        # pages are returned in order, even though they are fetched concurrently
+        assert [page.data["offset"] for page in result] == [0, 10, 20, 30, 40]
+        # up to two pages after the first empty page may have been requested
+        assert 6 <= len(pipe.queries) <= 8
+        assert query.offset == 50
+
+    @pytest.mark.parametrize("prefetch", [0, 2])
+    def test_exhausted_iterator_stays_exhausted(self, prefetch):
+        pipe = MockPipe(rows=20)
+
+        query = PagedPipeQuery(pipe=pipe, page_size=10, start_at=0, prefetch=prefetch)
+        assert len(list(query)) == 2
+        queries = len(pipe.queries)
+
+        with pytest.raises(StopIteration):
+            next(query)
+        assert len(pipe.queries) == queries
+
+    def test_close_as_context_manager(self):
+        pipe = MockPipe(rows=100)
+
+        with PagedPipeQuery(pipe=pipe, page_size=10, start_at=0, prefetch=2) as query:
+            for page in query:
+                if page.data["offset"] == 20:
+                    break
+
+        assert query._executor is None
+        assert not query._pending
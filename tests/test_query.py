@@ -40,11 +40,13 @@ _mock_json_response = """{
         "bytes_read": 296
     }
 }"""
+_mock_json_response_bytes = _mock_json_response.encode("utf-8")
 
 
 def test_json(httpserver: HTTPServer):
     def handler(request):
-        return Response(_mock_json_response, 200)
+        assert request.headers["Authorization"] == "Bearer 12345"
+        return Response(_mock_json_response_bytes, 200, content_type="application/json")
 
     httpserver.expect_request(
         "/v0/sql", query_string={"q": "select * from mytable FORMAT JSON"}
@@ -58,6 +60,20 @@ def test_json(httpserver: HTTPServer):
     assert len(response.data) == 2
 
 
+def test_json_uses_current_token(httpserver: HTTPServer):
+    def handler(request):
+        assert request.headers["Authorization"] == "Bearer 67890"
+        return Response(_mock_json_response_bytes, 200, content_type="application/json")
+
+    httpserver.expect_request("/v0/sql").respond_with_handler(handler)
+
+    query = SqlQuery("select * from mytable", token="12345", api=httpserver.url_for("/"))
+    query.token = "67890"
+
+    assert len(query.json().data) == 2
+    httpserver.check()
+
+
 def test_json_error(httpserver: HTTPServer):
     def handler(request):
         return Response('{"error": "invalid datasource"}', 403)
@@ -72,3 +88,18 @@ def test_json_error(httpserver: HTTPServer):
         query.json()
     e.match("403")
     e.match("invalid datasource")
+
+
+def test_iter_rows(httpserver: HTTPServer):
+    rows = '{"VendorID":2,"passenger_count":5}\n{"VendorID":1,"passenger_count":3}\n'
+
+    httpserver.expect_request(
+        "/v0/sql", query_string={"q": "select * from mytable FORMAT JSONEachRow"}
+    ).respond_with_data(rows, content_type="application/x-ndjson")
+
+    query = SqlQuery("select * from mytable", token="12345", api=httpserver.url_for("/"))
+
+    assert list(query.iter_rows()) == [
+        {"VendorID": 2, "passenger_count": 5},
+        {"VendorID": 1, "passenger_count": 3},
+    ]
@@ -0,0 +1,49 @@
+import pytest
+
+from verdin import serde
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_loads(monkeypatch, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(serde, "orjson", None)
+
+    doc = serde.loads('{"data": [{"name": "ä", "value": 1.5}], "rows": 1}'.encode("utf-8"))
+
+    assert doc == {"data": [{"name": "ä", "value": 1.5}], "rows": 1}
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps(monkeypatch, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(serde, "orjson", None)
+
+    data = serde.dumps({"name": "ä", "values": [1, 2.5, None]})
+
+    assert isinstance(data, bytes)
+    assert serde.loads(data) == {"name": "ä", "values": [1, 2.5, None]}
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_append_newline(monkeypatch, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(serde, "orjson", None)
+
+    assert serde.dumps({"a": [1, 2]}, append_newline=True) == b'{"a":[1,2]}\n'
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_non_str_keys_and_big_integers(monkeypatch, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(serde, "orjson", None)
+
+    assert serde.dumps({1: "a"}) == b'{"1":"a"}'
+    assert serde.dumps({"a": 2**70}, append_newline=True) == b'{"a":%d}\n' % 2**70
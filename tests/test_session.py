@@ -0,0 +1,44 @@
+from pytest_httpserver import HTTPServer
+
+from verdin.client import Client
+from verdin.datasource import Datasource
+from verdin.pipe import Pipe
+from verdin.query import SqlQuery
+from verdin.session import create_session, get_default_session
+
+
+def test_create_session_retries_idempotent_requests(httpserver: HTTPServer):
+    httpserver.expect_ordered_request("/v0/pipes/mypipe.json").respond_with_data("", 503)
+    httpserver.expect_ordered_request("/v0/pipes/mypipe.json").respond_with_json({"data": []})
+
+    session = create_session()
+    response = session.get(httpserver.url_for("/v0/pipes/mypipe.json"))
+
+    httpserver.check()
+    assert response.ok
+    assert response.json() == {"data": []}
+
+
+def test_create_session_does_not_retry_post(httpserver: HTTPServer):
+    httpserver.expect_oneshot_request("/v0/datasources", method="POST").respond_with_data("", 503)
+
+    session = create_session()
+    response = session.post(httpserver.url_for("/v0/datasources"), data="a,1\n")
+
+    httpserver.check()
+    assert response.status_code == 503
+
+
+def test_resources_share_default_session():
+    assert get_default_session() is get_default_session()
+    assert Datasource("ds", None).session is Pipe("pipe", None).session
+    assert SqlQuery("select 1", None).session is get_default_session()
+
+
+def test_client_resources_share_client_session():
+    client = Client("p.token")
+
+    assert client.session is not get_default_session()
+    assert client.datasource("ds").session is client.session
+    assert client.pipe("pipe").session is client.session
+    assert client.sql("select 1").session is client.session
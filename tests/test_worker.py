@@ -1,11 +1,14 @@
+import datetime
+import email.utils
 import threading
 import time
 from queue import Queue
 
+import pytest
 import requests
 
 from verdin.datasource import Datasource
-from verdin.worker import QueuingDatasourceAppender
+from verdin.worker import QueuingDatasourceAppender, StopWorker, TokenBucket
 
 
 class QueueingDatasource(Datasource):
@@ -53,6 +56,88 @@ class TestQueuingDatasourceAppender:
         thread.join(timeout=2)
         assert appender.stopped.is_set()
 
+    def test_batching_respects_max_batch_size(self):
+        source = Queue()
+        destination = QueueingDatasource("datasource")
+
+        appender = QueuingDatasourceAppender(source, destination, max_batch_size=2)
+        appender.min_interval = 0
+
+        source.put(("a", 1))
+        source.put(("b", 2))
+        source.put(("c", 3))
+
+        thread = threading.Thread(target=appender.run)
+        thread.start()
+
+        batch = destination.queue.get(timeout=1)
+        assert batch == [("a", 1), ("b", 2)]
+
+        batch = destination.queue.get(timeout=1)
+        assert batch == [("c", 3)]
+
+        appender.close()
+        thread.join(timeout=2)
+        assert appender.stopped.is_set()
+
+    def test_get_batch(self):
+        source = Queue(maxsize=4)
+        appender = QueuingDatasourceAppender(source, QueueingDatasource("datasource"))
+
+        for i in range(4):
+            source.put(("a", i))
+
+        assert appender._get_batch(3) == [("a", 0), ("a", 1), ("a", 2)]
+        # draining the queue must wake up producers blocked on a full queue
+        source.put(("b", 0), timeout=1)
+        source.put(("b", 1), timeout=1)
+        source.put(StopWorker.marker)
+
+        with pytest.raises(StopWorker) as e:
+            appender._get_batch()
+        assert e.value.batch == [("a", 3), ("b", 0), ("b", 1)]
+
+    def test_get_batch_does_not_compare_records_with_marker(self):
+        class Record:
+            def __eq__(self, other):
+                raise AssertionError("records must not be compared")
+
+        source = Queue()
+        appender = QueuingDatasourceAppender(source, QueueingDatasource("datasource"))
+        records = [Record(), Record()]
+        source.put(records[0])
+        source.put(records[1])
+
+        assert appender._get_batch() == records
+
+    def test_parse_retry_seconds(self):
+        appender = QueuingDatasourceAppender(Queue(), QueueingDatasource("datasource"))
+
+        response = requests.Response()
+        response.status_code = 429
+        response.headers["Retry-After"] = "2"
+        for _ in range(10):
+            assert 2 <= appender._parse_retry_seconds(response) <= 3
+
+        retry_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=10)
+        response.headers["Retry-After"] = email.utils.format_datetime(retry_at, usegmt=True)
+        assert 8 <= appender._parse_retry_seconds(response) <= 15
+
+        response.headers["Retry-After"] = "Wed, 21 Oct 2015 07:28:00 GMT"
+        assert appender._parse_retry_seconds(response) == 0
+
+        # without Retry-After, the backoff grows exponentially with full jitter up to max_backoff
+        del response.headers["Retry-After"]
+        for _ in range(10):
+            assert 0 <= appender._parse_retry_seconds(response, 0) <= 1
+            assert 0 <= appender._parse_retry_seconds(response, 3) <= 8
+            assert 0 <= appender._parse_retry_seconds(response, 20) <= appender.max_backoff
+
+        # an explicitly configured default_retry_after replaces the exponential backoff
+        appender.default_retry_after = 4
+        for _ in range(10):
+            assert 4 <= appender._parse_retry_seconds(response, 20) <= 6
+
     def test_stop_while_running(self):
         # instrument the queue
         source = Queue()
@@ -68,6 +153,133 @@ class TestQueuingDatasourceAppender:
         thread.join(timeout=2)
         assert appender.stopped.is_set()
 
+    def test_close_with_full_queue(self):
+        source = Queue(maxsize=1)
+        appender = QueuingDatasourceAppender(source, QueueingDatasource("datasource"))
+        source.put(("a", 1))
+
+        appender.close()
+
+        assert source.qsize() == 2
+        with pytest.raises(StopWorker) as e:
+            appender._get_batch()
+        assert e.value.batch == [("a", 1)]
+
+    def test_no_wait_after_successful_retry(self):
+        class MockQueueingDatasource(QueueingDatasource):
+            first_call = True
+
+            def append(self, records) -> requests.Response:
+                if self.first_call:
+                    self.first_call = False
+
+                    response = requests.Response()
+                    response.status_code = 429
+                    response.headers["Retry-After"] = "0"
+                    return response
+
+                return super().append(records)
+
+        source = Queue()
+        destination = MockQueueingDatasource("datasource")
+        appender = QueuingDatasourceAppender(source, destination, min_interval=0)
+        appender.wait_after_rate_limit = 30
+
+        source.put(("a", 1))
+
+        thread = threading.Thread(target=appender.run)
+        thread.start()
+
+        assert destination.queue.get(timeout=2) == [("a", 1)]
+        source.put(("b", 2))
+        # the retry succeeded, so the appender doesn't wait for the rate-limit window to reset
+        assert destination.queue.get(timeout=2) == [("b", 2)]
+
+        appender.close()
+        thread.join(timeout=2)
+        assert appender.stopped.is_set()
+
+    def test_close_while_rate_limited(self):
+        class RateLimitedDatasource(QueueingDatasource):
+            def append(self, records) -> requests.Response:
+                response = requests.Response()
+                response.status_code = 429
+                response.headers["Retry-After"] = "30"
+                return response
+
+        source = Queue()
+        appender = QueuingDatasourceAppender(source, RateLimitedDatasource("datasource"))
+        appender.max_flush_wait = 0.1
+        source.put(("a", 1))
+
+        thread = threading.Thread(target=appender.run)
+        thread.start()
+        time.sleep(0.2)
+
+        appender.close()
+        thread.join(timeout=2)
+        assert not thread.is_alive()
+
+    def test_close_while_waiting_after_rate_limit_flushes_batch(self):
+        class MockQueueingDatasource(QueueingDatasource):
+            calls = 0
+
+            def append(self, records) -> requests.Response:
+                self.calls += 1
+                if self.calls == 1:
+                    response = requests.Response()
+                    response.status_code = 429
+                    response.headers["Retry-After"] = "3"
+                    return response
+
+                return super().append(records)
+
+        source = Queue()
+        destination = MockQueueingDatasource("datasource")
+        appender = QueuingDatasourceAppender(source, destination)
+        appender.max_flush_wait = 0.1
+        source.put(("a", 1))
+
+        thread = threading.Thread(target=appender.run)
+        thread.start()
+        time.sleep(0.2)
+
+        appender.close()
+        thread.join(timeout=2)
+        assert not thread.is_alive()
+
+        # the batch is retried right away instead of being dropped
+        assert destination.calls == 2
+        assert destination.queue.get_nowait() == [("a", 1)]
+
+    def test_flush_on_close_is_retried(self):
+        class MockQueueingDatasource(QueueingDatasource):
+            calls = 0
+
+            def append(self, records) -> requests.Response:
+                self.calls += 1
+                if self.calls == 1:
+                    response = requests.Response()
+                    response.status_code = 429
+                    response.headers["Retry-After"] = "0.1"
+                    return response
+
+                return super().append(records)
+
+        destination = MockQueueingDatasource("datasource")
+        appender = QueuingDatasourceAppender(Queue(), destination)
+        appender.close()
+
+        # this is how the worker flushes the last batch it received with the stop marker
+        response, since_limited = appender._retry_batch(
+            [("a", 1)], max_retries=2, interruptible=False
+        )
+
+        assert response.ok
+        assert since_limited is None
+        assert destination.calls == 2
+        assert destination.queue.get_nowait() == [("a", 1)]
+
     def test_retry(self):
         class MockQueueingDatasource(QueueingDatasource):
             first_call = True
@@ -109,3 +321,58 @@ class TestQueuingDatasourceAppender:
         appender.close()
         thread.join(timeout=5)
         assert appender.stopped.is_set()
+
+
+class TestTokenBucket:
+    def test_reserve(self):
+        bucket = TokenBucket(rate=10, burst=2)
+
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == 0
+        # the bucket is empty, reservations are spread out at the current rate
+        assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+        assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+    def test_aimd(self):
+        bucket = TokenBucket(rate=8, increase=1, increase_after=2)
+
+        bucket.on_rate_limited()
+        assert bucket.rate == 4
+        # rate limits within the same refill period don't decrease the rate again
+        bucket.on_rate_limited()
+        assert bucket.rate == 4
+
+        bucket._decreased_at -= 1
+        bucket.on_rate_limited()
+        assert bucket.rate == 2
+
+        bucket.on_success()
+        assert bucket.rate == 2
+        bucket.on_success()
+        assert bucket.rate == 3
+
+        for _ in range(20):
+            bucket.on_success()
+        assert bucket.rate == 8
+
+    @pytest.mark.parametrize("rate,burst", [(0, 1), (-1, 1), (1, 0.5)])
+    def test_invalid_arguments(self, rate, burst):
+        with pytest.raises(ValueError):
+            TokenBucket(rate=rate, burst=burst)
+
+    def test_shared_by_appenders(self):
+        bucket = TokenBucket(rate=20, burst=1)
+        destination = QueueingDatasource("datasource")
+        appenders = [
+            QueuingDatasourceAppender(Queue(), destination, min_interval=0, rate_limiter=bucket)
+            for _ in range(2)
+        ]
+
+        then = time.monotonic()
+        for appender in appenders:
+            appender._retry_batch([("a", 1)])
+            appender._retry_batch([("b", 2)])
+
+        # four requests at 20 requests per second with a burst of one take at least 0.15 seconds
+        assert time.monotonic() - then >= 0.14
+        assert destination.queue.qsize() == 4
@@ -1,32 +1,40 @@
 from typing import Optional
 
+import requests
+
 from . import config
 from .datasource import Datasource
 from .pipe import Pipe
 from .query import OutputFormat, SqlQuery
+from .session import create_session
 
 
 class Client:
     """
-    Tinybird HTTP client that holds the access token and provides factory methods for resources.
+    Tinybird HTTP client that holds the access token and provides factory methods for resources. All
+    resources created by the client share the client's ``requests.Session``, and therefore its
+    connection pool.
     """
 
-    def __init__(self, token: str, api: str = None):
-        self.api = (api or config.API_URL).lstrip("/")
+    def __init__(self, token: str, api: str = None, session: requests.Session = None):
+        self.api = (api or config.API_URL).rstrip("/")
         self.token = token
+        self.session = session or create_session()
 
     def pipe(self, name: str, version: int = None) -> Pipe:
         """
         Create an object representing a pipe with the given name, e.g.,
         "localstack_dashboard_events.json"
         """
-        return Pipe(name, token=self.token, version=version, api=self.api)
+        return Pipe(name, token=self.token, version=version, api=self.api, session=self.session)
 
     def datasource(self, name: str, version: int = None) -> Datasource:
         """
         Create an object representing a datasource with a given name.
         """
-        return Datasource(name, token=self.token, version=version, api=self.api)
+        return Datasource(
+            name, token=self.token, version=version, api=self.api, session=self.session
+        )
 
     def sql(self, sql: str, format: Optional[OutputFormat] = None) -> SqlQuery:
-        return SqlQuery(sql, format=format, token=self.token, api=self.api)
+        return SqlQuery(sql, format=format, token=self.token, api=self.api, session=self.session)
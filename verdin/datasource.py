@@ -1,13 +1,14 @@
 import csv
 import io
-import json
 import logging
 import os
-from typing import Any, Dict, List, Optional, Tuple, Union
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import requests
 
-from . import config
+from . import config, serde
+from .session import get_default_session
 
 LOG = logging.getLogger(__name__)
 
@@ -21,7 +22,72 @@ def to_csv(records: Records, **kwargs) -> str:
     return output.getvalue()
 
 
+def to_ndjson(records: List[Union[Dict, str, bytes]]) -> bytes:
+    """
+    Serializes the given records into an NDJSON document. Records that are already serialized JSON
+    documents (``str`` or ``bytes``) are used as they are, which saves serializing them again. They
+    must be single-line JSON documents; one trailing line break (``\\n`` or ``\\r\\n``) is removed.
+    """
+    data = bytearray()
+    for record in records:
+        if isinstance(record, str):
+            record = record.encode("utf-8")
+
+        if isinstance(record, bytes):
+            if record.endswith(b"\n"):
+                record = record[:-2] if record.endswith(b"\r\n") else record[:-1]
+            data += record
+            data += b"\n"
+        else:
+            data += serde.dumps(record, append_newline=True)
+
+    return bytes(data)
+
+
+def iter_csv(records: Records, chunk_size: int = 64 * 1024, **kwargs) -> Iterator[bytes]:
+    """
+    Generates the CSV representation of the given records as UTF-8 encoded chunks of roughly
+    ``chunk_size`` bytes. Passing the generator as request body streams the records with chunked
+    transfer encoding, so the full CSV document never needs to be held in memory.
+    """
+    buffer = io.StringIO()
+    writer = _create_csv_writer(buffer, **kwargs)
+
+    for record in records:
+        writer.writerow(record)
+
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def gzip_chunks(chunks: Iterable[bytes], compresslevel: int = 1) -> Iterator[bytes]:
+    """
+    Compresses the given stream of chunks into a gzip stream, chunk by chunk, so compression
+    overlaps with sending the request instead of buffering the entire compressed body first.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
 def write_csv(file, records: Records, **kwargs):
+    writer = _create_csv_writer(file, **kwargs)
+
+    for record in records:
+        writer.writerow(record)
+
+
+def _create_csv_writer(file, **kwargs):
     # TODO: do proper type conversion here to optimize for CSV input
     #  see: https://guides.tinybird.co/guide/fine-tuning-csvs-for-fast-ingestion
 
@@ -29,10 +95,7 @@ def write_csv(file, records: Records, **kwargs):
         if kwargs["delimiter"] is None:
             del kwargs["delimiter"]
 
-    writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL, lineterminator="\n", **kwargs)
-
-    for record in records:
-        writer.writerow(record)
+    return csv.writer(file, quoting=csv.QUOTE_MINIMAL, lineterminator="\n", **kwargs)
 
 
 class Datasource:
@@ -45,11 +108,14 @@ class Datasource:
     name: str
     version: Optional[int]
 
-    def __init__(self, name, token, version: int = None, api=None) -> None:
+    def __init__(
+        self, name, token, version: int = None, api=None, session: requests.Session = None
+    ) -> None:
         self.name = name
         self.token = token
         self.version = version
         self.api = (api or config.API_URL).rstrip("/") + self.endpoint
+        self.session = session or get_default_session()
 
     @property
     def canonical_name(self):
@@ -62,7 +128,17 @@ class Datasource:
         # TODO: replicate tinybird API concepts instead of returning Response
         return self.append_csv(records, *args, **kwargs)
 
-    def append_csv(self, records: List[Record], delimiter: str = ",") -> requests.Response:
+    def append_csv(
+        self, records: List[Record], delimiter: str = ",", compress: bool = False
+    ) -> requests.Response:
+        """
+        Appends the given records in CSV format.
+
+        :param records: the records to append
+        :param delimiter: the CSV delimiter
+        :param compress: whether to gzip the request body (sent with ``Content-Encoding: gzip``)
+        :return: the HTTP response
+        """
         params = {"name": self.canonical_name, "mode": "append"}
         if delimiter:
             params["dialect_delimiter"] = delimiter
@@ -71,7 +147,11 @@ class Datasource:
         if self.token:
             headers["Authorization"] = f"Bearer {self.token}"
 
-        data = self.to_csv(records, delimiter=delimiter)
+        data = self.iter_csv(records, delimiter=delimiter)
+
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+            data = gzip_chunks(data)
 
         LOG.debug(
             "appending %d csv records to %s via %s(%s)",
@@ -81,9 +161,19 @@ class Datasource:
             params,
         )
         # TODO: use multipart
-        return requests.post(url=self.api, params=params, headers=headers, data=data)
-
-    def append_ndjson(self, records: List[Dict]) -> requests.Response:
+        return self.session.post(url=self.api, params=params, headers=headers, data=data)
+
+    def append_ndjson(
+        self, records: List[Union[Dict, str, bytes]], compress: bool = False
+    ) -> requests.Response:
+        """
+        Appends the given records in NDJSON format. Records can be dictionaries, or single-line JSON
+        documents that were already serialized by the caller (``str`` or ``bytes``).
+
+        :param records: the records to append
+        :param compress: whether to gzip the request body (sent with ``Content-Encoding: gzip``)
+        :return: the HTTP response
+        """
         # TODO: generalize appending in different formats
         query = {"name": self.canonical_name, "mode": "append", "format": "ndjson"}
 
@@ -91,8 +181,11 @@ class Datasource:
         if self.token:
             headers["Authorization"] = f"Bearer {self.token}"
 
-        docs = [json.dumps(record) for record in records]
-        data = "\n".join(docs)
+        data = to_ndjson(records)
+
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+            data = b"".join(gzip_chunks([data]))
 
         LOG.debug(
             "appending %d ndjson records to %s via %s(%s)",
@@ -101,12 +194,16 @@ class Datasource:
             self.api,
             query,
         )
-        return requests.post(url=self.api, params=query, headers=headers, data=data)
+        return self.session.post(url=self.api, params=query, headers=headers, data=data)
 
     @staticmethod
     def to_csv(records: List[List[Any]], **kwargs):
         return to_csv(records, **kwargs)
 
+    @staticmethod
+    def iter_csv(records: List[List[Any]], **kwargs) -> Iterator[bytes]:
+        return iter_csv(records, **kwargs)
+
     def __str__(self):
         return f"Datasource({self.canonical_name})"
 
@@ -131,7 +228,7 @@ class FileDatasource(Datasource):
         response.status_code = 200
         return response
 
-    def append_ndjson(self, records: List[Dict]) -> requests.Response:
+    def append_ndjson(self, records: List[Dict], compress: bool = False) -> requests.Response:
         raise NotImplementedError
 
     def readlines(self) -> List[str]:
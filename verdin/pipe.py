@@ -1,36 +1,53 @@
 import logging
-from typing import Any, Dict, Iterator, List, Optional, Tuple
+import operator
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
 
 import requests
 
-from . import config
+from . import config, serde
+from .session import get_default_session
 
 LOG = logging.getLogger(__name__)
 
 PipeMetadata = List[Tuple[str, str]]
 PipeJsonData = List[Dict[str, Any]]
 
+_name_and_type = operator.itemgetter("name", "type")
+
 
 class PipeError(Exception):
     response: requests.Response
 
     def __init__(self, response) -> None:
         self.response = response
-        self.json: Dict = response.json()
+        self.json: Dict = _parse_error_document(response)
         super().__init__(self.description)
 
     @property
     def description(self):
-        return self.json.get("error")
+        return self.json.get("error") or self.response.text
+
+
+def _parse_error_document(response: requests.Response) -> Dict:
+    # error responses are not guaranteed to be JSON (e.g., errors returned by a proxy)
+    try:
+        doc = serde.loads(response.content)
+    except ValueError:
+        return {}
+    return doc if isinstance(doc, dict) else {}
 
 
 class PipeJsonResponse:
+    __slots__ = ("response", "result")
+
     response: requests.Response
     result: Dict
 
     def __init__(self, response):
         self.response = response
-        self.result = response.json()
+        self.result = serde.loads(response.content)
 
     @property
     def empty(self):
@@ -38,37 +55,114 @@ class PipeJsonResponse:
 
     @property
     def meta(self) -> PipeMetadata:
-        return [(t["name"], t["type"]) for t in self.result.get("meta", [])]
+        return list(map(_name_and_type, self.result.get("meta", [])))
 
     @property
     def data(self) -> PipeJsonData:
         return self.result.get("data")
 
+    def to_columns(self) -> Dict[str, List[Any]]:
+        """
+        Returns the data in columnar form: a dictionary that maps each column name (in the order of
+        the response metadata) to the list of values of that column.
+        """
+        names = [name for name, _ in self.meta]
+        rows = self.data or []
+
+        if not names:
+            return {}
+        if not rows:
+            return {name: [] for name in names}
+        if len(names) == 1:
+            return {names[0]: [row[names[0]] for row in rows]}
+
+        columns = zip(*map(operator.itemgetter(*names), rows))
+        return {name: list(values) for name, values in zip(names, columns)}
+
 
 PipePageIterator = Iterator[PipeJsonResponse]
 
 
 class PagedPipeQuery(PipePageIterator):
+    """
+    Iterates over the result of a pipe page by page, until the pipe returns an empty page. With
+    ``prefetch`` set, up to that many subsequent pages are requested concurrently in the background
+    while the current page is being consumed, which hides the round-trip time of each page. This may
+    issue up to ``prefetch`` requests beyond the last page. When the iteration is stopped early,
+    call ``close()`` (or use the query as a context manager) to cancel pending prefetch requests.
+    """
+
     # TODO: allow passing of custom parameters
 
     pipe: "Pipe"
 
-    def __init__(self, pipe: "Pipe", page_size: int = 50, start_at: int = 0):
+    def __init__(self, pipe: "Pipe", page_size: int = 50, start_at: int = 0, prefetch: int = 0):
         self.pipe = pipe
         self.limit = page_size
         self.offset = start_at
+        self.prefetch = prefetch
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Deque[Future] = deque()
+        self._next_offset = start_at
+        self._done = False
 
     def __iter__(self):
         return self
 
+    def __enter__(self) -> "PagedPipeQuery":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     def __next__(self):
-        sql = f"SELECT * FROM _ LIMIT {self.limit} OFFSET {self.offset}"
-        response = self.pipe.sql(sql)
+        if self._done:
+            raise StopIteration()
+
+        if self.prefetch:
+            response = self._next_prefetched()
+        else:
+            response = self.pipe.sql(self._sql(self.offset))
+
         if response.empty:
+            self._done = True
+            self.close()
             raise StopIteration()
         self.offset += self.limit
         return response
 
+    def close(self):
+        """
+        Cancels pending prefetch requests and releases the background threads.
+        """
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _next_prefetched(self) -> PipeJsonResponse:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.prefetch + 1)
+
+        while len(self._pending) <= self.prefetch:
+            sql = self._sql(self._next_offset)
+            self._pending.append(self._executor.submit(self.pipe.sql, sql))
+            self._next_offset += self.limit
+
+        try:
+            return self._pending.popleft().result()
+        except Exception:
+            self._done = True
+            self.close()
+            raise
+
+    def _sql(self, offset: int) -> str:
+        return f"SELECT * FROM _ LIMIT {self.limit} OFFSET {offset}"
+
 
 class Pipe:
     """
@@ -83,12 +177,15 @@ class Pipe:
     version: Optional[int]
     resource: str
 
-    def __init__(self, name, token, version: int = None, api=None) -> None:
+    def __init__(
+        self, name, token, version: int = None, api=None, session: requests.Session = None
+    ) -> None:
         super().__init__()
         self.name = name
         self.token = token
         self.version = version
         self.resource = (api or config.API_URL).rstrip("/") + self.endpoint
+        self.session = session or get_default_session()
 
     @property
     def canonical_name(self):
@@ -99,22 +196,30 @@ class Pipe:
 
     @property
     def pipe_url(self):
-        return self.resource + "/" + self.canonical_name + ".json"
+        return f"{self.resource}/{self.canonical_name}.json"
 
     def query(self, params=None) -> PipeJsonResponse:
         params = params or dict()
         if "token" not in params and self.token:
             params["token"] = self.token
 
-        response = requests.get(self.pipe_url, params=params)
+        response = self.session.get(self.pipe_url, params=params)
 
         if response.ok:
             return PipeJsonResponse(response)
         else:
             raise PipeError(response)
 
-    def pages(self, page_size: int = 50, start_at: int = 0) -> PipePageIterator:
-        return PagedPipeQuery(pipe=self, page_size=page_size, start_at=start_at)
+    def pages(self, page_size: int = 50, start_at: int = 0, prefetch: int = 0) -> PagedPipeQuery:
+        """
+        Returns an iterator over the pages of the pipe's result.
+
+        :param page_size: the number of rows per page
+        :param start_at: the offset of the first page
+        :param prefetch: the number of pages to request concurrently ahead of the current one
+        :return: a page iterator, which should be closed if the iteration is stopped early
+        """
+        return PagedPipeQuery(pipe=self, page_size=page_size, start_at=start_at, prefetch=prefetch)
 
     def sql(self, query: str) -> PipeJsonResponse:
         """
@@ -127,7 +232,7 @@ class Pipe:
         headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
         params = {"q": query}
 
-        response = requests.get(self.pipe_url, headers=headers, params=params)
+        response = self.session.get(self.pipe_url, headers=headers, params=params)
 
         if response.ok:
             return PipeJsonResponse(response)
@@ -1,10 +1,11 @@
 import enum
 import logging
-from typing import Any, Dict, List, Optional, TypedDict
+from typing import Any, Dict, Iterator, List, Optional, TypedDict
 
 import requests
 
-from . import config
+from . import config, serde
+from .session import get_default_session
 
 LOG = logging.getLogger(__name__)
 
@@ -42,12 +43,14 @@ class JsonResult(TypedDict):
 
 
 class QueryJsonResult:
+    __slots__ = ("response", "result")
+
     response: requests.Response
     result: JsonResult
 
     def __init__(self, response: requests.Response):
         self.response = response
-        self.result = response.json()
+        self.result = serde.loads(response.content)
 
     @property
     def empty(self):
@@ -65,13 +68,14 @@ class QueryJsonResult:
 class QueryError(Exception):
     def __init__(self, response: requests.Response) -> None:
         self.response = response
-        msg = response.text
+        msg = None
         try:
-            doc = response.json()
-            if doc["error"]:
-                msg = doc["error"]
+            msg = serde.loads(response.content)["error"]
         except Exception:
             pass
+        if not msg:
+            # only decode the body as text if it doesn't contain a JSON error message
+            msg = response.text
         super().__init__(f"{response.status_code}: {msg}")
 
 
@@ -85,13 +89,29 @@ class SqlQuery:
     sql: str
     format: Optional[OutputFormat]
 
-    def __init__(self, sql: str, token, format: Optional[OutputFormat] = None, api=None) -> None:
+    def __init__(
+        self,
+        sql: str,
+        token,
+        format: Optional[OutputFormat] = None,
+        api=None,
+        session: requests.Session = None,
+    ) -> None:
         self.sql = sql
         self.format = format or OutputFormat.JSON
         self.token = token
         self.api = (api or config.API_URL).rstrip("/") + self.endpoint
+        self.session = session or get_default_session()
+
+    def get(self, format: Optional[OutputFormat] = None, stream: bool = False):
+        """
+        Runs the query and returns the raw response.
 
-    def get(self, format: Optional[OutputFormat] = None):
+        :param format: the output format (defaults to the format of the query)
+        :param stream: whether to defer downloading the response body until it is accessed
+        :return: the HTTP response
+        :raises QueryError: if the query failed
+        """
         # TODO: replicate tinybird API concepts instead of returning Response
         query = {"q": self._sql_with_format(format or self.format)}
 
@@ -104,7 +124,7 @@ class SqlQuery:
             self.api,
             query,
         )
-        response = requests.get(url=self.api, params=query, headers=headers)
+        response = self.session.get(url=self.api, params=query, headers=headers, stream=stream)
 
         if not response.ok:
             raise QueryError(response)
@@ -116,6 +136,16 @@ class SqlQuery:
 
         return QueryJsonResult(response)
 
+    def iter_rows(self) -> Iterator[JsonData]:
+        """
+        Runs the query with ``FORMAT JSONEachRow`` and yields the rows one by one while the response
+        is being read, so large results never need to be held in memory at once.
+        """
+        with self.get(OutputFormat.JSONEachRow, stream=True) as response:
+            for line in response.iter_lines(chunk_size=64 * 1024):
+                if line:
+                    yield serde.loads(line)
+
     def _sql_with_format(self, output_format: Optional[OutputFormat] = None):
         # TODO: handle potentially already existing FORMAT string
         if not output_format:
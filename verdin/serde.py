@@ -0,0 +1,42 @@
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data: bytes) -> Any:
+    """
+    Parses the given UTF-8 encoded JSON document. Uses orjson if it is installed (``pip install
+    verdin[orjson]``), which parses bytes directly and is considerably faster for large responses.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any, append_newline: bool = False) -> bytes:
+    """
+    Serializes the given object into a compact UTF-8 encoded JSON document, using orjson if it is
+    installed. Objects that orjson rejects but the stdlib accepts (e.g., integers that exceed 64
+    bits) are serialized with the stdlib, so the result doesn't depend on whether orjson is
+    installed.
+
+    :param obj: the object to serialize
+    :param append_newline: whether to terminate the document with a newline (e.g., for NDJSON)
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if append_newline:
+            option |= orjson.OPT_APPEND_NEWLINE
+        try:
+            return orjson.dumps(obj, option=option)
+        except TypeError:
+            pass
+
+    doc = json.dumps(obj, separators=(",", ":"))
+    if append_newline:
+        doc += "\n"
+    return doc.encode("utf-8")
@@ -0,0 +1,55 @@
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+pool_connections: int = 32
+pool_maxsize: int = 32
+
+_default_session: Optional[requests.Session] = None
+_default_session_lock = threading.Lock()
+
+
+def create_session() -> requests.Session:
+    """
+    Creates a ``requests.Session`` with a connection pool that is large enough to be shared by
+    multiple threads (e.g., several QueuingDatasourceAppender workers), so sockets are kept alive
+    under bursts instead of being closed and re-opened.
+
+    Idempotent requests (e.g., pipe or SQL queries) are retried on rate limiting and transient
+    server errors, respecting the Retry-After header. Appends are POST requests and are never
+    retried by the adapter, rate limiting of appends is handled by the QueuingDatasourceAppender.
+    """
+    retries = Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(429, 502, 503, 504),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retries
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_default_session() -> requests.Session:
+    """
+    Returns the module-wide session shared by all resources that are created without an explicit
+    session (e.g., ``Datasource(...)`` instead of ``client.datasource(...)``), so they still share
+    one connection pool. The session is created lazily on first use.
+    """
+    global _default_session
+
+    if _default_session is None:
+        with _default_session_lock:
+            if _default_session is None:
+                _default_session = create_session()
+
+    return _default_session
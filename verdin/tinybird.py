@@ -1,6 +1,14 @@
 from .client import Client
 from .datasource import Datasource, Record
-from .pipe import Pipe, PipeError, PipeJsonData, PipeJsonResponse, PipeMetadata, PipePageIterator
+from .pipe import (
+    PagedPipeQuery,
+    Pipe,
+    PipeError,
+    PipeJsonData,
+    PipeJsonResponse,
+    PipeMetadata,
+    PipePageIterator,
+)
 from .query import OutputFormat, QueryError, QueryJsonResult, SqlQuery
 
 __all__ = [
@@ -13,6 +21,7 @@ __all__ = [
     "PipeJsonData",
     "PipeJsonResponse",
     "PipePageIterator",
+    "PagedPipeQuery",
     "SqlQuery",
     "QueryError",
     "OutputFormat",
@@ -1,7 +1,10 @@
+import datetime
+import email.utils
 import logging
-import multiprocessing
+import random
+import threading
 import time
-from queue import Empty, Queue
+from queue import Full, Queue
 from typing import Optional, Tuple
 
 import requests
@@ -16,7 +19,8 @@ class StopWorker(Exception):
     An exception that indicates to stop the QueueingDatasourceAppender worker.
     """
 
-    marker = "__STOP__"
+    # compared by identity, so it can neither be forged by a record nor trigger a record's __eq__
+    marker = object()
 
     batch: Optional[Records]
 
@@ -24,50 +28,179 @@ class StopWorker(Exception):
         self.batch = batch
 
 
+class TokenBucket:
+    """
+    A thread-safe token bucket that paces requests and adapts its rate to rate limiting (additive
+    increase, multiplicative decrease): the rate is halved when a request is rate limited, and
+    increased by ``increase`` after every ``increase_after`` consecutive successful requests, up to
+    ``max_rate``. Further rate-limited requests within one refill period (``burst / rate`` seconds)
+    after a decrease are attributed to the same congestion and don't decrease the rate again. A
+    single TokenBucket can be shared by several QueuingDatasourceAppender instances that append into
+    the same workspace, so they converge to a fair share of the workspace's quota instead of each
+    bursting until it is rate limited.
+    """
+
+    rate: float
+    burst: float
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = 1,
+        max_rate: float = None,
+        min_rate: float = None,
+        increase: float = None,
+        increase_after: int = 10,
+    ) -> None:
+        """
+        :param rate: the initial number of requests per second
+        :param burst: the maximum number of requests that can be made without waiting
+        :param max_rate: the upper bound of the rate (defaults to the initial rate)
+        :param min_rate: the lower bound of the rate (defaults to 1% of the initial rate)
+        :param increase: the additive increase of the rate (defaults to 10% of max_rate)
+        :param increase_after: the number of consecutive successful requests before increasing
+        :raises ValueError: if the rate is not positive, or the burst is smaller than one request
+        """
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, was {rate}")
+        if burst < 1:
+            raise ValueError(f"burst must be at least 1, was {burst}")
+
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate or rate
+        self.min_rate = min_rate or rate / 100
+        self.increase = increase or self.max_rate / 10
+        self.increase_after = increase_after
+
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._successes = 0
+        self._decreased_at: Optional[float] = None
+        self._mutex = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token from the bucket, and returns the number of seconds the caller needs to wait
+        before the token is valid (0 if a token was available). Reservations are made in order, so
+        concurrent callers are spread out at the current rate.
+
+        :return: the seconds to wait before making the request
+        """
+        with self._mutex:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def on_success(self):
+        """
+        Records a successful request, and increases the rate after enough of them.
+        """
+        with self._mutex:
+            self._successes += 1
+            if self._successes >= self.increase_after:
+                self._successes = 0
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_rate_limited(self):
+        """
+        Records a rate-limited request, and halves the rate unless it was already decreased within
+        the last refill period.
+        """
+        with self._mutex:
+            self._successes = 0
+
+            now = time.monotonic()
+            if self._decreased_at is not None and now - self._decreased_at < self.burst / self.rate:
+                return
+
+            self._decreased_at = now
+            self.rate = max(self.min_rate, self.rate / 2)
+
+
 class QueuingDatasourceAppender:
     """
     A QueuingDatasourceAppender reads batches of records from a source Queue and appends the batches to a data
     source. Once rate limited, it waits for the instructed amount of time (or if that is not specified,
-    whatever default_retry_after is set to), before appending again.
+    an exponentially growing backoff with full jitter), before appending again. Waits are jittered
+    so that multiple appenders that were rate limited together don't retry in lockstep.
 
-    See https://docs.tinybird.co/api-reference/api-reference.html#limits-title
+    Data sources share rate limits across the workspace, so running multiple separate appenders can
+    lead to excessive rate limiting. Passing the same TokenBucket as ``rate_limiter`` to all of them
+    paces their requests together.
 
-    TODO: synchronize multiple appenders through a RateLimiter concurrency structure: data source share rate limiting
-     across account or workspace (not sure), so running multiple separate queuing datasource appenders will lead to
-     excessive rate limiting.
+    See https://docs.tinybird.co/api-reference/api-reference.html#limits-title
     """
 
-    default_retry_after: float = 12
+    base_delay: float = 1
+    max_backoff: float = 30
+    # if set, a fixed (jittered) wait used instead of the exponential backoff when the API doesn't
+    # send a Retry-After header
+    default_retry_after: Optional[float] = None
     wait_after_rate_limit: float = 12
+    # the maximum time to wait between attempts to flush the last batch when the appender is closed
+    max_flush_wait: float = 5
 
     source: Queue
     destination: Datasource
     min_interval: float
-
-    def __init__(self, source: Queue, destination: Datasource, min_interval: float = 5) -> None:
+    max_batch_size: int
+    rate_limiter: Optional[TokenBucket]
+
+    def __init__(
+        self,
+        source: Queue,
+        destination: Datasource,
+        min_interval: float = 5,
+        max_batch_size: int = 1000,
+        rate_limiter: TokenBucket = None,
+    ) -> None:
         """
         :param source: a queue that buffers records to be appended to the datasource
         :param destination: the datasource to append to
         :param min_interval: the minimal time to wait between batches
+        :param max_batch_size: the maximum number of records to append in a single request
+        :param rate_limiter: an optional (possibly shared) token bucket that paces append requests
         """
         super().__init__()
         self.source = source
         self.destination = destination
-        self.stopped = multiprocessing.Event()
+        self.stopped = threading.Event()
         self.min_interval = min_interval
+        self.max_batch_size = max_batch_size
+        self.rate_limiter = rate_limiter
 
     def close(self):
         if self.stopped.is_set():
             return
         self.stopped.set()
-        self.source.put_nowait(StopWorker.marker)
+
+        q = self.source
+        try:
+            q.put_nowait(StopWorker.marker)
+        except Full:
+            # the worker may be blocked on an empty queue by the time a producer fills it up again,
+            # so the marker is enqueued regardless of the queue's maxsize
+            with q.mutex:
+                q._put(StopWorker.marker)
+                q.unfinished_tasks += 1
+                q.not_empty.notify()
 
     def run(self):
+        stopped = self.stopped
+        do_next_batch = self._do_next_batch
+        monotonic = time.monotonic
+
         try:
-            while not self.stopped.is_set():
+            while not stopped.is_set():
                 try:
-                    then = time.time()
-                    batch, error = self._do_next_batch()
+                    then = monotonic()
+                    batch, error = do_next_batch()
 
                     if error is not None:
                         # TODO: make sure the batch is not dropped on error. however, if the batch is
@@ -77,15 +210,14 @@ class QueuingDatasourceAppender:
 
                         raise error
 
-                    duration = time.time() - then
-                    LOG.debug("processing batch took %.2f", duration)
+                    LOG.debug("processing batch took %.2f", monotonic() - then)
                     if self.min_interval:
-                        self.stopped.wait(self.min_interval)
+                        stopped.wait(self.min_interval)
 
                 except StopWorker as e:
                     LOG.info("indicated worker shutdown, trying to flush batch")
                     if e.batch:
-                        self._retry_batch(e.batch, max_retries=2)
+                        self._retry_batch(e.batch, max_retries=2, interruptible=False)
                     return
 
                 except Exception:
@@ -107,67 +239,124 @@ class QueuingDatasourceAppender:
         q = self.source
         item = q.get()
 
-        if item == StopWorker.marker:
+        if item is StopWorker.marker:
             raise StopWorker()
 
         result = [item]  # block until we have at least one item
+        stop = False
 
-        if not n:
-            n = q.qsize()
+        # drain the rest of the batch while holding the queue's lock once, instead of acquiring it
+        # for every single item (this is what Queue.get_nowait does internally, minus the locking)
+        with q.mutex:
+            available = q._qsize()
+            if n:
+                available = min(available, n - 1)
 
-        try:
-            while len(result) <= n:
-                item = q.get(block=False)
+            drained = 0
+            while drained < available:
+                item = q._get()
+                drained += 1
 
-                if item == StopWorker.marker:
-                    raise StopWorker(result)
+                if item is StopWorker.marker:
+                    stop = True
+                    break
 
                 result.append(item)
-        except Empty:
-            pass
+
+            if drained:
+                q.not_full.notify(drained)
+
+        if stop:
+            raise StopWorker(result)
 
         return result
 
-    def _parse_retry_seconds(self, response: requests.Response) -> float:
+    def _parse_retry_seconds(self, response: requests.Response, attempt: int = 0) -> float:
+        """
+        Returns the number of seconds to wait before retrying a rate-limited request. That is the
+        Retry-After value of the response (either in seconds or as HTTP date) plus up to 50% jitter,
+        or, if the response doesn't specify it, ``default_retry_after`` plus jitter if that is set,
+        otherwise a random delay between 0 and ``base_delay * 2**attempt`` (capped at
+        ``max_backoff``).
+
+        :param response: the rate-limited response
+        :param attempt: the number of the attempt (starting at 0)
+        :return: the seconds to wait
+        """
         retry = response.headers.get("Retry-After")
         if retry:
             try:
-                return float(retry) + 0.5
-            except ValueError as e:
+                return _jitter(float(retry))
+            except ValueError:
+                pass
+
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry)
+                if retry_at.tzinfo is None:
+                    retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+                seconds = (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                return _jitter(max(0.0, seconds))
+            except (TypeError, ValueError) as e:
                 LOG.error("error while parsing Retry-After value '%s': %s", retry, e)
 
-        return self.default_retry_after
+        if self.default_retry_after is not None:
+            return _jitter(self.default_retry_after)
+
+        return random.random() * min(self.max_backoff, self.base_delay * 2**attempt)
 
-    def _retry_batch(self, batch, max_retries=10) -> Tuple[requests.Response, bool]:
+    def _retry_batch(
+        self, batch, max_retries=10, interruptible=True
+    ) -> Tuple[requests.Response, Optional[float]]:
         """
         Tries to append the given batch to the datasource for max_retries amount of times. It
         only retries if the request was rate limited, and waits for a certain amount of time
-        afterwards.
+        afterwards. If ``interruptible`` is set, waiting is interrupted when the appender is closed,
+        in which case the batch is flushed as if it was the last batch. Otherwise, every wait is
+        capped at ``max_flush_wait`` (used for flushing the last batch after the appender was
+        closed).
 
         :param batch: a list of records to append to the datasource
         :param max_retries: max number of retries (defaults to 10)
-        :return: a tuple with the last response and a boolean flag indicating whether the request
-                 was rate-limited
+        :param interruptible: whether closing the appender interrupts waiting
+        :return: a tuple with the last response and, if the last attempt was rate-limited, the
+                 number of seconds that passed since then (otherwise None)
         """
-        limited = False
+        limited_at = None
         response = None
+        rate_limiter = self.rate_limiter
+
+        for attempt in range(max_retries):
+            if rate_limiter:
+                wait = rate_limiter.reserve()
+                if wait:
+                    # the request is made even if the wait is interrupted by closing the appender
+                    self._wait(wait, interruptible)
 
-        for _ in range(max_retries):
             response = self.destination.append(batch)
 
             if response.ok:
-                return response, limited
+                if rate_limiter:
+                    rate_limiter.on_success()
+                return response, None
 
             if response.status_code == 429:
-                wait = self._parse_retry_seconds(response)
-                limited = True
-                LOG.debug(
-                    "rate limited by API, keeping %d records safe for %d seconds: %s",
-                    len(batch),
-                    wait,
-                    response.text,
-                )
-                time.sleep(wait)
+                if rate_limiter:
+                    rate_limiter.on_rate_limited()
+                wait = self._parse_retry_seconds(response, attempt)
+                limited_at = time.monotonic()
+                if LOG.isEnabledFor(logging.DEBUG):
+                    # only decode the response body if it is actually logged
+                    LOG.debug(
+                        "rate limited by API, keeping %d records safe for %.2f seconds: %s",
+                        len(batch),
+                        wait,
+                        response.text,
+                    )
+                if attempt == max_retries - 1:
+                    break
+                if self._wait(wait, interruptible):
+                    LOG.info("appender closed while rate limited, trying to flush batch")
+                    return self._retry_batch(batch, max_retries=2, interruptible=False)
                 continue
 
             LOG.warning(
@@ -175,12 +364,30 @@ class QueuingDatasourceAppender:
                 response.status_code,
                 response.text,
             )
-            return response, limited
+            return response, None
 
-        return response, limited
+        if limited_at is None:
+            return response, None
+
+        LOG.warning(
+            "still rate limited after %d attempts, dropping %d records", max_retries, len(batch)
+        )
+        return response, time.monotonic() - limited_at
+
+    def _wait(self, seconds: float, interruptible: bool) -> bool:
+        """
+        Waits for the given number of seconds.
+
+        :return: True if the wait was interrupted because the appender was closed
+        """
+        if interruptible:
+            return self.stopped.wait(seconds)
+
+        time.sleep(min(seconds, self.max_flush_wait))
+        return False
 
     def _do_next_batch(self) -> Tuple[Records, Optional[Exception]]:
-        batch = self._get_batch()
+        batch = self._get_batch(self.max_batch_size)
 
         try:
             LOG.debug(
@@ -189,22 +396,24 @@ class QueuingDatasourceAppender:
                 self.destination.name,
             )
 
-            response, limited = self._retry_batch(batch)
+            response, since_limited = self._retry_batch(batch)
 
-            if limited:
-                # if the request was rate-limited, we'll try again after X-Ratelimit-Reset, or the
-                # wait_after_rate_limit value if it is set
+            if since_limited is not None:
+                # if the last attempt was rate-limited, we'll try again after X-Ratelimit-Reset, or
+                # the wait_after_rate_limit value if it is set, minus the time we already waited
+                # since. if a retry succeeded, the rate-limit window has evidently reset already.
                 try:
                     if self.wait_after_rate_limit:
-                        wait = self.wait_after_rate_limit
+                        wait = _jitter(self.wait_after_rate_limit)
                     else:
-                        wait = float(response.headers.get("X-Ratelimit-Reset", 0))
+                        wait = _jitter(float(response.headers.get("X-Ratelimit-Reset", 0)))
+                    wait = max(0.0, wait - since_limited)
 
                     LOG.info(
-                        "waiting %d second until rate-limit window resets before batching again",
+                        "waiting %.2f seconds until rate-limit window resets before batching again",
                         wait,
                     )
-                    time.sleep(wait)
+                    self.stopped.wait(wait)
                 except ValueError:
                     LOG.exception("error while parsing X-Ratelimit-Reset value")
 
@@ -212,3 +421,8 @@ class QueuingDatasourceAppender:
             return batch, e
 
         return batch, None
+
+
+def _jitter(seconds: float) -> float:
+    # spreads out waits of clients that were told to wait the same amount of time
+    return seconds + random.uniform(0, seconds / 2)